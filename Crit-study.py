@@ -1,10 +1,29 @@
 import streamlit as st
 import pandas as pd
-import fitparse
-import matplotlib.pyplot as plt
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Figures are only ever rendered to images, so skip GUI backend selection
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 import io
-import math
+import os
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pandas import ExcelWriter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from fit_reader import read_fit_power
+from bout_core import find_bouts, w_prime_balance, combine_bouts, combine_zone_seconds, sum_file_field, calculate_depletions_and_zones
+
+# Prefer xlsxwriter for the Excel export (noticeably faster); fall back to openpyxl if it isn't installed
+try:
+    import xlsxwriter  # noqa: F401
+    EXCEL_ENGINE = 'xlsxwriter'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
 
 # --- App Configuration ---
 st.set_page_config(
@@ -16,152 +35,176 @@ st.set_page_config(
 # -------------------
 # Data Processing & Analysis Functions
 # -------------------
-@st.cache_data
-def parse_fit_file(uploaded_file):
-    """Parses an uploaded .fit file and returns a DataFrame with time and power."""
-    uploaded_file.seek(0)
+# Cached helpers are keyed on a file's content digest (or a key built from digests and parameters);
+# underscore-prefixed arguments are fully determined by that key, so Streamlit does not hash them
+@st.cache_resource
+def _fit_parse_pool():
+    """Returns the process pool shared by every session for decoding FIT files."""
+    # Spawned rather than forked: forking the multi-threaded Streamlit server is not safe
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+
+def _decode_fit(data):
+    """Decodes FIT bytes in the shared process pool, replacing the pool and retrying once if a worker has died."""
+    pool = _fit_parse_pool()
     try:
-        fitfile = fitparse.FitFile(uploaded_file)
-        # Extract records that have a non-null power value
-        records = [
-            data for record in fitfile.get_messages('record')
-            if (data := record.get_values()) and 'power' in data and data['power'] is not None
-        ]
+        return pool.submit(read_fit_power, data).result()
+    except BrokenProcessPool:
+        # A dead worker (e.g. OOM-killed) leaves the pool unusable for good, so start a fresh one
+        pool.shutdown(wait=False, cancel_futures=True)
+        # Another file's thread may already have replaced it
+        if _fit_parse_pool() is pool:
+            _fit_parse_pool.clear()
+        return _fit_parse_pool().submit(read_fit_power, data).result()
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def parse_fit_file(digest, _data):
+    """Parses the raw bytes of a .fit file and returns a DataFrame with time and power."""
+    # A resource cache hands back the stored DataFrame itself (no pickled copy), so callers must not modify it
+    try:
+        # Decoding is GIL-bound Python, so it runs in the process pool; this thread just waits for the arrays
+        timestamps, powers = _decode_fit(_data)
+    except BrokenProcessPool:
+        # A pool failure says nothing about the file, so it is raised rather than cached against the digest
+        raise
     except Exception as e:
-        return f"Error parsing {uploaded_file.name}: {e}"
-    if not records: return None
-
-    df = pd.DataFrame(records)
-    # Resample to 1-second intervals to ensure consistent data points
-    df = df.set_index('timestamp').resample('1S').ffill().reset_index()
-    # Calculate elapsed time in seconds
-    df['time'] = (df['timestamp'] - df['timestamp'].iloc[0]).dt.total_seconds()
-    return df[['time', 'power']]
+        return f"Error parsing FIT file {digest}: {e}"
+    if len(powers) == 0: return None
 
-def analyze_bouts(time_values, power_values, cp):
+    elapsed = timestamps - timestamps.min()
+    if np.all(np.diff(elapsed) == 1):
+        # Already a gap-free 1 Hz recording (the usual case), so the samples are the grid
+        power = powers
+    else:
+        # Place each sample on a 1-second grid by its elapsed time, then forward-fill any gaps
+        power = np.full(elapsed.max() + 1, np.nan, dtype=np.float32)
+        power[elapsed] = powers
+        power = pd.Series(power).ffill().to_numpy()
+    # Whole seconds are exact in float32 for rides of up to ~190 days
+    return pd.DataFrame({'time': np.arange(len(power), dtype=np.float32), 'power': power})
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def analyze_bouts(digest, _time_arr, _power_arr, cp):
     """Identifies high-intensity bouts from power data based on a CP threshold."""
     threshold_factor = 1.00  # Set threshold to 100% of CP
-    threshold_power = cp * threshold_factor
     min_bout_duration = 3
     gap_tolerance = 3  # Allow for short drops below the threshold
-    bouts = []
-    duration, avg_power, below_counter, start_time = 0, 0, 0, None
-
-    for t, p in zip(time_values, power_values):
-        if p > threshold_power:
-            if duration == 0: start_time = t
-            duration += 1
-            avg_power += p
-            below_counter = 0
-        else:
-            if duration > 0:
-                below_counter += 1
-                if below_counter <= gap_tolerance:
-                    # If within tolerance, continue the bout
-                    duration += 1
-                    avg_power += p
-                else:
-                    # If gap is too long, end the bout
-                    if duration >= min_bout_duration:
-                        magnitude = (avg_power / duration / cp) * 100
-                        if magnitude >= threshold_factor * 100:
-                            bouts.append({'start_time': start_time, 'duration': duration, 'magnitude': magnitude})
-                    duration, avg_power, below_counter, start_time = 0, 0, 0, None
-
-    # Check for a bout that might be ongoing at the end of the file
-    if duration >= min_bout_duration:
-        magnitude = (avg_power / duration / cp) * 100
-        if magnitude >= threshold_factor * 100:
-            bouts.append({'start_time': start_time, 'duration': duration, 'magnitude': magnitude})
-
-    bouts_df = pd.DataFrame(bouts)
-    if not bouts_df.empty:
-        # Assign colors for plotting based on magnitude
-        bouts_df['color'] = bouts_df['magnitude'].apply(lambda mag: 'red' if mag >= 170 else ('orange' if mag >= 140 else 'blue'))
-    return bouts_df
-
-def calculate_w_prime_balance(power_series, cp, w_prime, A, B):
-    """Calculates the W' balance over time using a differential recovery model."""
-    w_balance = w_prime
-    w_bal_list = []
-    for p in power_series:
-        if p > cp:
-            w_balance -= (p - cp)  # Expenditure
-        else:
-            w_expended = w_prime - w_balance
-            delta_p = cp - p
-            if delta_p > 0:
-                tau = A * (delta_p ** B)
-                if tau > 0:
-                    w_balance += w_expended * (1 - math.exp(-1 / tau))  # Recovery
-        w_balance = min(w_prime, max(0, w_balance))
-        w_bal_list.append(w_balance)
-    return pd.Series(w_bal_list)
-
-def calculate_depletions_and_zones(w_bal_series, w_prime, time_series):
-    """Counts critical depletions and calculates time spent in W' balance zones."""
-    # The total duration for percentage calculation is the length of the selected time series
-    total_duration = len(time_series)
-    depletion_threshold = 0.15 * w_prime
-    depletion_count = 0
-    depletion_times = []
-    below_threshold = False
-
-    for i, val in enumerate(w_bal_series):
-        if val < depletion_threshold and not below_threshold:
-            depletion_count += 1
-            # Get the actual time value from the time_series at the specific index
-            depletion_times.append(time_series.iloc[i])
-            below_threshold = True
-        elif val >= depletion_threshold:
-            below_threshold = False
-
-    w_bal_percent = (w_bal_series / w_prime) * 100
-    bins = [-1, 10, 15, 25, 50, 70, 101]
-    labels = ['0-10%', '10-15%', '15-25%', '25-50%', '50-70%', '70-100%']
-
-    if w_bal_percent.empty:
-        zone_counts = pd.Series(0, index=labels)
-    else:
-        zone_counts = pd.cut(w_bal_percent, bins=bins, labels=labels, right=False).value_counts().sort_index()
-
-    zone_data = pd.DataFrame({
-        'Time (s)': zone_counts,
-        'Time (%)': (zone_counts / total_duration * 100).round(2) if total_duration > 0 else 0
-    })
-    return depletion_count, zone_data, depletion_times
+    start_times, durations, magnitudes = find_bouts(
+        np.ascontiguousarray(_time_arr, dtype=np.float32), np.ascontiguousarray(_power_arr, dtype=np.float32),
+        float(cp), threshold_factor, min_bout_duration, gap_tolerance
+    )
+    # Assign colors for plotting based on magnitude (stored as Arrow strings rather than Python objects)
+    colors = pd.array(np.select([magnitudes >= 170, magnitudes >= 140], ['red', 'orange'], default='blue'), dtype='string[pyarrow]')
+    # Durations are whole seconds well within int32; magnitude stays float64 for the Excel export
+    return pd.DataFrame({'start_time': start_times, 'duration': durations.astype(np.int32), 'magnitude': magnitudes, 'color': colors})
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def calculate_w_prime_balance(digest, _power_arr, cp, w_prime, A, B):
+    """Calculates the W' balance over time using a differential recovery model (cached per file digest)."""
+    return pd.Series(w_prime_balance(np.ascontiguousarray(_power_arr, dtype=np.float32), float(cp), float(w_prime), float(A), float(B)))
+
+def file_digest(uploaded_file):
+    """Returns a short content digest used to key parsed files."""
+    # Hash a view of the upload's buffer rather than a getvalue() copy of it
+    with uploaded_file.getbuffer() as view:
+        return hashlib.blake2b(view, digest_size=16).hexdigest()
+
+def analyze_file(uploaded_file, digest, parsed_files, cp, w_prime, A, B):
+    """Parses one file and runs the full-file bout and W'bal calculations; returns None if there is no power data."""
+    # Files already parsed in this session are reused without touching the cache
+    if digest not in parsed_files:
+        try:
+            parsed_files[digest] = parse_fit_file(digest, uploaded_file.getvalue())
+        except BrokenProcessPool:
+            # The pool broke again on retry; report this file as failed for this run only
+            return None
+    data_df = parsed_files[digest]
+    if not isinstance(data_df, pd.DataFrame) or data_df.empty:
+        return None
+    time_arr, power_arr = data_df['time'].to_numpy(), data_df['power'].to_numpy()
+    return data_df, analyze_bouts(digest, time_arr, power_arr, cp), calculate_w_prime_balance(digest, power_arr, cp, w_prime, A, B)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def combine_file_results(combined_key, _all_files_data):
+    """Combines the per-file results into (combined bouts, total depletions, total duration, combined zone table)."""
+    all_files_data = _all_files_data
+    combined_bouts_df = combine_bouts(all_files_data)
+    total_depletions = sum_file_field(all_files_data, 'depletion_count')
+    total_duration = sum_file_field(all_files_data, 'duration')
+    combined_zones_df = None
+    if total_duration > 0:
+        total_zone_seconds = combine_zone_seconds(all_files_data)
+        combined_zones_df = pd.DataFrame({'Total Time (s)': total_zone_seconds, 'Total Time (%)': (total_zone_seconds / total_duration * 100).round(2)})
+    return combined_bouts_df, total_depletions, total_duration, combined_zones_df
 
 # -------------------
 # Plotting & Export Functions
 # -------------------
+@functools.lru_cache(maxsize=8)
+def _w_prime_curves(cp, w_prime):
+    """Returns the time axis and a (5, 70) array of W' depletion curves (10-50% W') as % of CP."""
+    # lru_cache hands back the same arrays on every hit (no copy), so they are made read-only
+    t = np.arange(1, 71)
+    depletions = np.arange(10, 60, 10)[:, None]
+    curves = ((w_prime * (depletions / 100) / t) + cp) / cp * 100
+    t.flags.writeable = curves.flags.writeable = False
+    return t, curves
+
+@st.cache_data
+def _w_prime_curves_df(cp, w_prime):
+    """Returns the W' depletion curves as the 70-row table written to the Excel export."""
+    t, curves = _w_prime_curves(cp, w_prime)
+    w_prime_curves_df = pd.DataFrame(curves.T, columns=[f"{depletion}% W' Depletion (%CP)" for depletion in range(10, 60, 10)])
+    w_prime_curves_df.insert(0, 'Time (s)', t)
+    return w_prime_curves_df
+
+def _session_figure(key, **figure_kwargs):
+    """Returns a cleared Figure kept in session state, so each plot shape is built once rather than on every render."""
+    # Plain Figures (not pyplot) are used, so nothing needs closing; each is rendered to PNG before it is reused
+    figures = st.session_state.setdefault('figures', {})
+    if key not in figures:
+        figures[key] = Figure(**figure_kwargs)
+    fig = figures[key]
+    fig.clear()
+    return fig
+
+def _figure_png(fig):
+    """Renders a Figure to PNG bytes with the same settings st.pyplot uses."""
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=200, bbox_inches='tight')
+    return buf.getvalue()
 
 def create_summary_plots(bouts_df, cp, w_prime, title_prefix=""):
     """Creates a scatter plot of bout magnitude vs. duration."""
     if bouts_df.empty:
         st.warning(f"No bouts detected for {title_prefix} analysis.")
         return
+    if "Combined" in title_prefix:
+        st.subheader("Combined Magnitude vs. Bout Duration (Research Grade)")
+    else:
+        st.subheader(f"{title_prefix}Magnitude vs. Bout Duration")
+    st.image(_bout_chart_png(bouts_df, cp, w_prime, title_prefix), width='stretch')
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def _bout_chart_png(bouts_df, cp, w_prime, title_prefix):
+    """Draws the magnitude vs. duration chart and returns it as PNG bytes (cached, so reruns skip drawing)."""
     bout_durations = bouts_df['duration']
     magnitudes = bouts_df['magnitude']
     # Set default colors from the initial analysis
     bout_colors = bouts_df['color']
+    # Beyond this many bouts, individual markers are replaced by a hexbin density plot
+    max_scatter_bouts = 5000
+    binned = len(bouts_df) > max_scatter_bouts
 
     # Apply "Research Grade" styling ONLY for the combined chart
     if "Combined" in title_prefix:
-        st.subheader("Combined Magnitude vs. Bout Duration (Research Grade)")
-        fig1, ax1 = plt.subplots(figsize=(8, 6), dpi=300)
+        fig1 = _session_figure('combined_bouts', figsize=(8, 6), dpi=300)
+        ax1 = fig1.add_subplot()
         
-        # Calculate new bout colors based on W' depletion for the combined chart
-        bouts_df['depletion'] = (cp * (bouts_df['magnitude'] / 100 - 1) * bouts_df['duration']) / w_prime * 100
-
-        def get_depletion_color(depletion):
-            if depletion <= 10: return 'blue'
-            elif depletion <= 20: return 'orange'
-            elif depletion <= 40: return 'yellow'
-            elif depletion <= 50: return 'lightcoral'
-            else: return 'red'
-
-        bout_colors = bouts_df['depletion'].apply(get_depletion_color)
+        # Calculate new bout colors based on W' depletion for the combined chart (not needed when binned)
+        if not binned:
+            depletion = ((cp * (bouts_df['magnitude'] / 100 - 1) * bouts_df['duration']) / w_prime * 100).to_numpy()
+            bout_colors = np.select([depletion <= 10, depletion <= 20, depletion <= 40, depletion <= 50],
+                                    ['blue', 'orange', 'yellow', 'lightcoral'], default='red')
 
         font_settings = {'fontfamily': 'Arial', 'fontsize': 12, 'fontweight': 'bold'}
         title_font_settings = {'fontfamily': 'Arial', 'fontsize': 16, 'fontweight': 'bold'}
@@ -180,51 +223,58 @@ def create_summary_plots(bouts_df, cp, w_prime, title_prefix=""):
         ax1.grid(False)
         
     else:  # Keep original styling for individual file charts
-        st.subheader(f"{title_prefix}Magnitude vs. Bout Duration")
-        fig1, ax1 = plt.subplots(figsize=(10, 5))
+        fig1 = _session_figure('file_bouts', figsize=(10, 5))
+        ax1 = fig1.add_subplot()
         ax1.set_xlabel('Bout Duration (s)')
         ax1.set_ylabel('Magnitude (% of CP)')
         ax1.set_title(f'{title_prefix}Magnitude vs Bout Duration (>100% CP)')
         ax1.grid(alpha=0.4)
 
     # Common plotting logic for both chart styles
-    ax1.scatter(bout_durations, magnitudes, c=bout_colors, alpha=0.7, label='Individual Bouts', edgecolor='black', linewidth=0.2)
+    y_max = max(250, magnitudes.max() * 1.1 if not magnitudes.empty else 250)
+    if binned:
+        # Aggregate into hexagonal bins over the visible area so drawing cost scales with bins, not bouts
+        bins = ax1.hexbin(bout_durations, magnitudes, gridsize=50, extent=(0, 70, 100, y_max), mincnt=1, bins='log', cmap='viridis', label='Binned Bouts')
+        fig1.colorbar(bins, ax=ax1, label='Bouts per Bin')
+    else:
+        ax1.scatter(bout_durations, magnitudes, c=bout_colors, alpha=0.7, label='Individual Bouts', edgecolor='black', linewidth=0.2)
     avg_duration = bout_durations.mean()
     avg_magnitude = magnitudes.mean()
     ax1.scatter(avg_duration, avg_magnitude, color='black', marker='X', s=200, edgecolor='white', linewidth=1.5, label=f'Overall Average ({avg_duration:.0f}s, {avg_magnitude:.0f}%)', zorder=5)
 
-    # Plot W' depletion curves for reference
+    # Plot W' depletion curves for reference, all in a single LineCollection (one draw call)
+    t, curves = _w_prime_curves(cp, w_prime)
+    segments = np.stack([np.broadcast_to(t, curves.shape), curves], axis=-1)
     if "Combined" in title_prefix:
         grayscale_colors = ['0.0', '0.3', '0.45', '0.6', '0.75']  # Black to lightest grey
-        for i, depletion in enumerate(range(10, 60, 10)):
-            x_values = range(1, 71)
-            w_prime_depleted = w_prime * (depletion / 100)
-            y_values = [(((w_prime_depleted / t) + cp) / cp) * 100 for t in x_values]
-            ax1.plot(x_values, y_values, color=grayscale_colors[i], linestyle='--', linewidth=1.2, label=f"{depletion}% W'")
+        ax1.add_collection(LineCollection(segments, colors=grayscale_colors, linestyles='--', linewidths=1.2))
+        # The research chart keeps one legend entry per depletion level, so add proxy handles for them
+        curve_handles = [Line2D([], [], color=color, linestyle='--', linewidth=1.2, label=f"{depletion}% W'")
+                         for color, depletion in zip(grayscale_colors, range(10, 60, 10))]
     else:
-        for depletion in range(10, 60, 10):
-            x_values = range(1, 71)
-            w_prime_depleted = w_prime * (depletion / 100)
-            y_values = [(((w_prime_depleted / t) + cp) / cp) * 100 for t in x_values]
-            ax1.plot(x_values, y_values, 'k:', linewidth=0.7, label=f"{depletion}% W'")
+        ax1.add_collection(LineCollection(segments, colors='k', linestyles=':', linewidths=0.7, label="10-50% W' depletion"))
+        curve_handles = []
 
     # Set common axis limits
-    ax1.set_ylim(100, max(250, magnitudes.max() * 1.1 if not magnitudes.empty else 250))
+    ax1.set_ylim(100, y_max)
     ax1.set_xlim(0, 70)
     
     # Customize legend for the research plot
+    legend_handles = ax1.get_legend_handles_labels()[0] + curve_handles
     if "Combined" in title_prefix:
-        ax1.legend(fontsize=10, frameon=False)
+        ax1.legend(handles=legend_handles, fontsize=10, frameon=False)
         fig1.subplots_adjust(top=0.92) # Add space above the title
     else:
-        ax1.legend()
-        
-    st.pyplot(fig1)
+        ax1.legend(handles=legend_handles)
+
+    return _figure_png(fig1)
 
-def plot_w_prime_balance(time_series, w_bal_series, w_prime):
-    """Plots the W' balance over time."""
-    w_bal_percent = (w_bal_series / w_prime) * 100
-    fig, ax = plt.subplots(figsize=(10, 4))
+@st.cache_data(show_spinner=False, max_entries=32)
+def plot_w_prime_balance(digest, cp, w_prime, A, B, _time_series, _w_bal_percent):
+    """Plots the W' balance (as % of W') over time and returns the chart as PNG bytes."""
+    time_series, w_bal_percent = _time_series, _w_bal_percent
+    fig = _session_figure('w_bal', figsize=(10, 4))
+    ax = fig.add_subplot()
     ax.plot(time_series, w_bal_percent, color='green', linewidth=1.5)
     ax.fill_between(time_series, 0, w_bal_percent, color='green', alpha=0.2)
     ax.set_xlabel("Time (s)")
@@ -233,35 +283,32 @@ def plot_w_prime_balance(time_series, w_bal_series, w_prime):
     ax.set_ylim(0, 105)
     ax.set_xlim(0, time_series.max() if not time_series.empty else 1)
     ax.grid(alpha=0.3)
-    return fig
+    return _figure_png(fig)
 
-def generate_excel_output(all_files_data, cp, w_prime):
+@st.cache_data(show_spinner=False, max_entries=8)
+def generate_excel_output(export_key, _all_files_data, _all_bouts_df, cp, w_prime):
     """Generates an Excel file with all analysis data."""
+    all_files_data, all_bouts_df = _all_files_data, _all_bouts_df
     output = io.BytesIO()
-    with ExcelWriter(output, engine='openpyxl') as writer:
-        # Consolidate all bouts from all files into a single DataFrame
-        all_bouts_df = pd.concat([f['bouts_df'] for f in all_files_data if not f['bouts_df'].empty], ignore_index=True)
+    with ExcelWriter(output, engine=EXCEL_ENGINE) as writer:
 
-        # Generate the W' depletion curves data
-        w_prime_curves_data = {'Time (s)': range(1, 71)}
-        for depletion in range(10, 60, 10):
-            w_prime_curves_data[f"{depletion}% W' Depletion (%CP)"] = [((w_prime * (depletion / 100) / t) + cp) / cp * 100 for t in w_prime_curves_data['Time (s)']]
-        w_prime_curves_df = pd.DataFrame(w_prime_curves_data)
+        # Fetch the W' depletion curves data (cached per CP / W' pair)
+        w_prime_curves_df = _w_prime_curves_df(cp, w_prime)
 
         # Sheet 1: Combined Bouts and Depletion Curves
-        # Merge the bout data with the corresponding W' depletion curve values based on duration
+        # Attach the W' depletion curve values matching each bout's duration
         if not all_bouts_df.empty:
             # Round duration to handle any potential floating point issues and convert to int
-            all_bouts_df['duration'] = all_bouts_df['duration'].round().astype(int)
-            
-            combined_df = pd.merge(
-                all_bouts_df,
-                w_prime_curves_df,
-                left_on='duration',
-                right_on='Time (s)',
-                how='left'
-            )
-            combined_df.drop(columns=['Time (s)'], inplace=True, errors='ignore')
+            durations = all_bouts_df['duration'].round().astype(int).to_numpy()
+            # The curve table has one row per second from 1 s, so a duration indexes its row directly;
+            # durations outside the table get an all-NaN row, as the previous left join on 'Time (s)' did
+            curve_values = w_prime_curves_df.drop(columns='Time (s)')
+            lookup = np.vstack([curve_values.to_numpy(), np.full(curve_values.shape[1], np.nan)])
+            rows = np.where((durations >= 1) & (durations <= len(curve_values)), durations - 1, len(curve_values))
+            combined_df = pd.concat([
+                all_bouts_df.assign(duration=durations),
+                pd.DataFrame(lookup[rows], columns=curve_values.columns, index=all_bouts_df.index)
+            ], axis=1)
             combined_df.to_excel(writer, sheet_name='Bouts vs Depletion Curves', index=False)
         else:
             # Create an empty sheet if there are no bouts, to maintain a consistent file structure
@@ -271,20 +318,20 @@ def generate_excel_output(all_files_data, cp, w_prime):
         w_prime_curves_df.to_excel(writer, sheet_name='W Prime Depletion Curves', index=False)
 
         # Sheet 3: Individual Zone Data
-        all_zone_rows = []
-        for file_data in all_files_data:
-            for zone_name, row in file_data['zone_data'].iterrows():
-                all_zone_rows.append({
-                    'File Name': file_data['name'], 'Zone': zone_name,
-                    'Time (s)': row['Time (s)'], 'Time (%)': row['Time (%)']
-                })
-        if all_zone_rows:
-            pd.DataFrame(all_zone_rows).to_excel(writer, sheet_name='Individual Zone Data', index=False)
+        # Every file has the same six zone rows, so the long table is built column-wise rather than row by row
+        if all_files_data:
+            zone_tables = [file_data['zone_data'] for file_data in all_files_data]
+            pd.DataFrame({
+                'File Name': np.repeat([file_data['name'] for file_data in all_files_data], [len(z) for z in zone_tables]),
+                'Zone': np.concatenate([z.index.to_numpy(dtype=object) for z in zone_tables]),
+                'Time (s)': np.concatenate([z['Time (s)'].to_numpy() for z in zone_tables]),
+                'Time (%)': np.concatenate([z['Time (%)'].to_numpy(dtype=np.float64) for z in zone_tables])
+            }).to_excel(writer, sheet_name='Individual Zone Data', index=False)
 
         # Sheet 4: Combined Zone Data
         if all_files_data:
-            total_zone_seconds = sum(f['zone_data']['Time (s)'] for f in all_files_data)
-            total_duration_all_files = sum(f['duration'] for f in all_files_data)
+            total_zone_seconds = combine_zone_seconds(all_files_data)
+            total_duration_all_files = sum_file_field(all_files_data, 'duration')
             if total_duration_all_files > 0:
                 combined_zones = pd.DataFrame({'Time (s)': total_zone_seconds, 'Time (%)': (total_zone_seconds / total_duration_all_files * 100).round(2)})
                 combined_zones.to_excel(writer, sheet_name='Combined Zones')
@@ -296,7 +343,7 @@ def generate_excel_output(all_files_data, cp, w_prime):
                 len(all_bouts_df) if not all_bouts_df.empty else 0,
                 all_bouts_df['magnitude'].mean() if not all_bouts_df.empty else 0,
                 all_bouts_df['duration'].mean() if not all_bouts_df.empty else 0,
-                sum(f['depletion_count'] for f in all_files_data) if all_files_data else 0
+                sum_file_field(all_files_data, 'depletion_count') if all_files_data else 0
             ]
         }
         pd.DataFrame(summary_metrics).to_excel(writer, sheet_name='Summary Stats', index=False)
@@ -343,21 +390,30 @@ else:
             all_files_data = []
             st.header("Individual File Analysis")
 
-            for file in uploaded_files:
+            # --- Step 1: Perform initial calculations on the FULL datasets ---
+            # Files are independent, so they are processed on worker threads (the Numba kernels release the GIL,
+            # and FIT decoding is handed to the process pool).
+            # Workers share this run's script context so the cached functions work; all UI is drawn serially below.
+            digests = [file_digest(file) for file in uploaded_files]
+            # Keep parsed data only for the files that are still uploaded
+            parsed_files = {d: df for d, df in st.session_state.get('parsed_files', {}).items() if d in digests}
+            st.session_state.parsed_files = parsed_files
+            ctx = get_script_run_ctx()
+            with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files)), initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+                results = list(executor.map(lambda f, d: analyze_file(f, d, parsed_files, cp, w_prime, tau_A, tau_B), uploaded_files, digests))
+
+            for file, digest, result in zip(uploaded_files, digests, results):
                 with st.expander(f"▶️ Analysis for: **{file.name}**", expanded=True):
-                    # Use a cached function to avoid reprocessing files unnecessarily
-                    data_df = parse_fit_file(file)
-                    if not isinstance(data_df, pd.DataFrame) or data_df.empty:
+                    if result is None:
                         st.error(f"Could not process {file.name} or no power data found.")
                         continue
-                    
-                    # --- Step 1: Perform initial calculations on the FULL dataset ---
-                    bouts_df = analyze_bouts(data_df['time'], data_df['power'], cp)
-                    w_bal_series_full = calculate_w_prime_balance(data_df['power'], cp, w_prime, tau_A, tau_B)
+                    data_df, bouts_df, w_bal_series_full = result
+                    # W'bal as % of W' is computed once per file and shared by the plot and the zone analysis
+                    w_bal_percent_full = (w_bal_series_full.to_numpy() / w_prime) * 100
 
                     # --- Step 2: Display full data plots and the new time range slider ---
                     st.subheader("W' Balance (W'bal) Analysis")
-                    st.pyplot(plot_w_prime_balance(data_df['time'], w_bal_series_full, w_prime))
+                    st.image(plot_w_prime_balance(digest, cp, w_prime, tau_A, tau_B, data_df['time'], w_bal_percent_full), width='stretch')
                     
                     min_time, max_time = float(data_df['time'].min()), float(data_df['time'].max())
                     
@@ -377,12 +433,14 @@ else:
                     start_time, end_time = selected_range
 
                     # --- Step 3: Filter data based on the selected range for Zone Analysis ---
-                    time_mask = (data_df['time'] >= start_time) & (data_df['time'] <= end_time)
-                    w_bal_series_filtered = w_bal_series_full[time_mask]
-                    time_series_filtered = data_df['time'][time_mask]
+                    # Time is sorted, so the selection is a contiguous slice found by binary search (a view, not a mask copy)
+                    time_values = data_df['time'].to_numpy()
+                    i0, i1 = np.searchsorted(time_values, start_time, 'left'), np.searchsorted(time_values, end_time, 'right')
+                    w_bal_series_filtered = w_bal_series_full.iloc[i0:i1]
+                    time_series_filtered = data_df['time'].iloc[i0:i1]
 
                     depletion_count, zone_data, _ = calculate_depletions_and_zones(
-                        w_bal_series_filtered, w_prime, time_series_filtered
+                        w_bal_series_filtered, w_prime, time_series_filtered, w_bal_percent_full[i0:i1]
                     )
 
                     # --- Step 4: Display the filtered results and append to all_files_data ---
@@ -396,6 +454,8 @@ else:
                     # Store data for combined analysis. Note: duration is now the length of the selection
                     all_files_data.append({
                         'name': file.name,
+                        'digest': digest,
+                        'time_range': selected_range,
                         'bouts_df': bouts_df, # Bouts are from the full file
                         'duration': len(time_series_filtered), # Duration of the selected range
                         'depletion_count': depletion_count, # Depletions from the selected range
@@ -418,30 +478,31 @@ else:
                 st.markdown("---")
                 st.header("📊 Combined Analysis for All Files (Based on Selections)")
                 st.subheader("Combined Summary Metrics")
-                combined_bouts_df = pd.concat([f['bouts_df'] for f in all_files_data if not f['bouts_df'].empty], ignore_index=True)
-                total_depletions = sum(f['depletion_count'] for f in all_files_data)
+                # Each file's digest and selected range plus the W'bal model parameters identify the combined results
+                export_key = (tuple((f['name'], f['digest'], f['time_range']) for f in all_files_data), tau_A, tau_B)
+                combined_bouts_df, total_depletions, total_duration_all, combined_zones_df = combine_file_results((export_key, cp, w_prime), all_files_data)
+                # Summary metrics come straight from the underlying arrays
+                all_magnitudes = combined_bouts_df['magnitude'].to_numpy()
+                all_durations = combined_bouts_df['duration'].to_numpy()
 
                 c1, c2, c3, c4 = st.columns(4)
-                c1.metric("Total Bouts (All Files)", f"{len(combined_bouts_df)}" if not combined_bouts_df.empty else "0")
-                c2.metric("Overall Avg. Magnitude", f"{combined_bouts_df['magnitude'].mean():.1f}% CP" if not combined_bouts_df.empty else "N/A")
-                c3.metric("Overall Avg. Duration", f"{combined_bouts_df['duration'].mean():.1f} s" if not combined_bouts_df.empty else "N/A")
+                c1.metric("Total Bouts (All Files)", f"{all_magnitudes.size}")
+                c2.metric("Overall Avg. Magnitude", f"{all_magnitudes.mean():.1f}% CP" if all_magnitudes.size else "N/A")
+                c3.metric("Overall Avg. Duration", f"{all_durations.mean():.1f} s" if all_durations.size else "N/A")
                 c4.metric("Total Critical Depletions 🔥", total_depletions)
 
                 if not combined_bouts_df.empty:
                     create_summary_plots(combined_bouts_df, cp, w_prime, title_prefix="Combined ")
 
                 st.subheader("Combined W'bal Time in Zones")
-                total_duration_all = sum(f['duration'] for f in all_files_data)
                 if total_duration_all > 0:
-                    total_zone_seconds = sum(f['zone_data']['Time (s)'] for f in all_files_data)
-                    combined_zones_df = pd.DataFrame({'Total Time (s)': total_zone_seconds, 'Total Time (%)': (total_zone_seconds / total_duration_all * 100).round(2)})
                     st.dataframe(combined_zones_df)
                     st.bar_chart(combined_zones_df['Total Time (%)'])
 
                 st.markdown("---")
                 st.header("⬇️ Download All Data")
-                excel_data = generate_excel_output(all_files_data, cp, w_prime)
-                st.download_button(label="📥 Download Full Analysis as Excel File", data=excel_data, file_name=f'full_analysis_{cp}W_CP.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+                # The workbook is only built when the button is clicked, and is cached for repeat downloads
+                st.download_button(label="📥 Download Full Analysis as Excel File", data=lambda: generate_excel_output(export_key, all_files_data, combined_bouts_df, cp, w_prime), file_name=f'full_analysis_{cp}W_CP.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     else:
         st.info(f"✅ **{len(uploaded_files)} file(s) loaded.** Adjust parameters and click 'Analyze Files' to process.")
 
@@ -2,78 +2,145 @@
 import streamlit as st
 import pandas as pd
 import re
+import hashlib
 from datetime import datetime
 
 # --- Data Parsing Function ---
 
+# Line patterns are compiled once at import rather than looked up for every pasted line
+STAGE_RACE_RE = re.compile(r'^\d{2}\.\d{2}\s›\s\d{2}\.\d{2}\s+(.*)')
+STAGE_RACE_CLEAN_RE = re.compile(r'\s*(?:more|\d+(?:Youth|Points|General))')
+# Any of these in a race name marks it as a stage of the current stage race
+STAGE_KEYWORD_RE = re.compile(r'Stage|Prologue|ITT|stage')
+# A distance token is a plain decimal number such as "187" or "187.4"
+DISTANCE_RE = re.compile(r'\d+(?:\.\d*)?|\.\d+')
+
+RESULT_COLUMNS = ['Rider', 'Year', 'Date', 'Result', 'Race', 'Distance']
+
 def parse_pasted_data(raw_text, rider_name, year):
     """
     This is the core function that takes the raw, pasted text and turns it
     into structured data. It now understands stage races.
+    The entries are returned column-wise, as one list per field in RESULT_COLUMNS.
     """
-    parsed_entries = []
+    dates, results, races, distances = [], [], [], []
     lines = raw_text.strip().split('\n')
     current_stage_race_name = ""
 
     for line in lines:
-        # Check for a stage race summary line first (e.g., "dd.mm › dd.mm Race Name")
-        stage_race_match = re.search(r'^\d{2}\.\d{2}\s›\s\d{2}\.\d{2}\s+(.*)', line)
+        # Both kinds of result line start with a fixed-width "dd.mm" date and whitespace, so this is checked
+        # by position first and any other line is skipped without running a regex
+        if not (len(line) > 5 and line[2] == '.' and line[:2].isdecimal() and line[3:5].isdecimal() and line[5].isspace()):
+            continue
+
+        # Check for a stage race summary line first (e.g., "dd.mm › dd.mm Race Name"); only a '›' straight after the date can start one
+        stage_race_match = STAGE_RACE_RE.match(line) if line[6:7] == '›' else None
         if stage_race_match:
             # It's a stage race summary. We extract the name and wait for stage lines.
             full_line_text = stage_race_match.group(1).strip()
-            # Clean up the name by removing extra text like "more" or classifications
-            current_stage_race_name = re.split(r'\s*(?:more|\d+Youth|\d+Points|\d+General)', full_line_text)[0].strip()
+            # Clean up the name by removing extra text like "more" or classifications (only the text before the first one is kept)
+            current_stage_race_name = STAGE_RACE_CLEAN_RE.split(full_line_text, maxsplit=1)[0].strip()
             continue
 
-        # Check for a single race day line (e.g., "dd.mm result Race Name distance")
-        single_day_match = re.match(r'^(\d{2}\.\d{2})\s+', line)
-        if single_day_match:
-            date_str = single_day_match.group(1)
-            rest_of_line = line[len(date_str):].strip()
-            tokens = rest_of_line.split()
+        # Otherwise it is a single race day line (e.g., "dd.mm result Race Name distance")
+        date_str = line[:5]
+        # split() drops the surrounding whitespace itself, so no separate strip pass is needed
+        tokens = line[5:].split()
 
-            if not tokens:
-                continue
+        if not tokens:
+            continue
 
-            # --- Extract Data from the tokens ---
-            result = tokens[0]
-            distance = 0.0
-            distance_found_at_index = -1
-
-            # Find the distance by searching from the end for a number
-            for i in range(len(tokens) - 1, 0, -1):
-                try:
-                    distance = float(tokens[i])
-                    distance_found_at_index = i
-                    break
-                except ValueError:
-                    continue
-
-            # The race name is everything between the result and the distance
-            if distance_found_at_index != -1:
-                race_name_tokens = tokens[1:distance_found_at_index]
-            else:
-                race_name_tokens = tokens[1:]
-
-            individual_race_name = ' '.join(race_name_tokens)
-
-            # Combine with stage race name if we're in one
-            final_race_name = f"{current_stage_race_name}: {individual_race_name}" if current_stage_race_name else individual_race_name
-            
-            # If the race name doesn't seem like a stage, we assume the stage race has ended
-            if not any(keyword in individual_race_name for keyword in ['Stage', 'Prologue', 'ITT', 'stage']):
-                 current_stage_race_name = ""
+        # --- Extract Data from the tokens ---
+        result = tokens[0]
+        distance = 0.0
+        distance_found_at_index = -1
+
+        # Find the distance by searching from the end for a number (checked by pattern, not by raising)
+        for i in range(len(tokens) - 1, 0, -1):
+            if DISTANCE_RE.fullmatch(tokens[i]):
+                distance = float(tokens[i])
+                distance_found_at_index = i
+                break
+
+        # The race name is everything between the result and the distance
+        if distance_found_at_index != -1:
+            race_name_tokens = tokens[1:distance_found_at_index]
+        else:
+            race_name_tokens = tokens[1:]
+
+        individual_race_name = ' '.join(race_name_tokens)
+
+        # Combine with stage race name if we're in one
+        final_race_name = f"{current_stage_race_name}: {individual_race_name}" if current_stage_race_name else individual_race_name
+        
+        # If the race name doesn't seem like a stage, we assume the stage race has ended
+        if not STAGE_KEYWORD_RE.search(individual_race_name):
+             current_stage_race_name = ""
+
+        dates.append(date_str)
+        results.append(result)
+        races.append(final_race_name)
+        distances.append(distance)
+
+    # Rider and year are the same for every entry in a season
+    return {'Rider': [rider_name] * len(dates), 'Year': [year] * len(dates), 'Date': dates, 'Result': results, 'Race': races, 'Distance': distances}
 
-            parsed_entries.append({
-                'Rider': rider_name,
-                'Year': year,
-                'Date': date_str,
-                'Result': result,
-                'Race': final_race_name,
-                'Distance': distance
-            })
+@st.cache_data(show_spinner=False, max_entries=256)
+def parse_season(raw_text, rider_name, year):
+    """Cached parse_pasted_data, so a repeat Process click only re-parses seasons whose inputs changed."""
+    return parse_pasted_data(raw_text, rider_name, year)
+
+def build_results_df(parsed_seasons):
+    """
+    Builds the dashboard DataFrame from the parsed seasons' columns. This runs once per
+    Process click, so the derived columns are computed here rather than on every rerun.
+    """
+    df = pd.DataFrame({col: [value for season in parsed_seasons for value in season[col]] for col in RESULT_COLUMNS})
+    # A handful of riders repeat over every row, so store them as categories; years fit comfortably in int16,
+    # and the text columns are held as Arrow strings rather than Python objects
+    df = df.astype({'Rider': 'category', 'Year': 'int16', 'Date': 'string[pyarrow]', 'Result': 'string[pyarrow]', 'Race': 'string[pyarrow]'})
+    # Placings are small whole numbers, exact in Float32; non-numeric results (DNF etc.) become missing values
+    df['Result_Numeric'] = pd.to_numeric(df['Result'], errors='coerce').astype('Float32')
+    # Dates are fixed-width 'dd.mm', so the month is a plain slice rather than a per-row split
+    df['Month'] = df['Date'].str.slice(3, 5).astype('int8')
+    return df
 
-    return parsed_entries
+# --- Dashboard Aggregations ---
+# Each is cached on data_key (a digest of the processed DataFrame) and the rider selection;
+# Streamlit skips hashing underscore-prefixed arguments, so _filtered_df is not hashed
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def race_days_by_rider(data_key, riders, _filtered_df):
+    """Counts the race days of each selected rider."""
+    # observed=True leaves out riders that are categories but not in the selection
+    return _filtered_df.groupby('Rider', observed=True).size().reset_index(name='Race Days')
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def monthly_average_results(data_key, riders, _filtered_df):
+    """Averages the numeric results of each selected rider by month, with one column per rider."""
+    # Placings are stored as Float32; average them in float64 so the plotted means stay exact
+    # Only the three columns the pivot needs are carried through dropna, not the whole filtered frame
+    results = _filtered_df[['Rider', 'Month', 'Result_Numeric']].dropna().astype({'Result_Numeric': 'float64'})
+    monthly_performance = results.groupby(['Rider', 'Month'], observed=True)['Result_Numeric'].mean().reset_index()
+    return monthly_performance.pivot(index='Month', columns='Rider', values='Result_Numeric')
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def dated_numeric_results(data_key, riders, _filtered_df):
+    """Returns the selected riders' numeric results with a full date, as the three columns the results-over-time scatter plots."""
+    results = _filtered_df.dropna(subset=['Result_Numeric'])
+    return pd.DataFrame({
+        # Assemble the dates from integer parts instead of concatenating and strptime-parsing strings
+        'Full_Date': pd.to_datetime({'year': results['Year'], 'month': results['Month'], 'day': results['Date'].str.slice(0, 2).astype('int8')}),
+        'Result_Numeric': results['Result_Numeric'],
+        'Rider': results['Rider']
+    })
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def rider_kpis(data_key, riders, _filtered_df):
+    """Computes each selected rider's race days, total distance and top-10 finishes in one grouped pass."""
+    # Non-numeric results compare as missing, which the sum skips, so they never count as a top 10
+    return _filtered_df.assign(top_10=_filtered_df['Result_Numeric'] <= 10).groupby('Rider', observed=True).agg(
+        race_days=('Date', 'size'), total_distance=('Distance', 'sum'), top_10s=('top_10', 'sum'))
 
 # --- Streamlit App UI ---
 
@@ -82,8 +149,9 @@ st.title('🚴 ProCycling Manual Data Analyzer')
 st.write("Manually input team, rider, and season data to build your own cycling performance dashboard.")
 
 # Initialize session state to hold data across reruns
-if 'all_processed_data' not in st.session_state:
-    st.session_state.all_processed_data = []
+if 'processed_df' not in st.session_state:
+    st.session_state.processed_df = None
+    st.session_state.processed_key = None
 
 # --- Step 1: Team and Rider Setup ---
 with st.expander("Step 1: Data Entry", expanded=True):
@@ -109,7 +177,7 @@ with st.expander("Step 1: Data Entry", expanded=True):
 # --- Step 2: Process Data and Build Dashboard ---
 st.markdown("---")
 if st.button("📊 Process and Build Dashboard", type="primary"):
-    st.session_state.all_processed_data = []
+    parsed_seasons = []
     with st.spinner("Parsing all pasted data..."):
         for rider_form in all_rider_forms:
             rider_name = rider_form['name']
@@ -121,20 +189,23 @@ if st.button("📊 Process and Build Dashboard", type="primary"):
                 year = season_form['year']
                 raw_text = season_form['raw_text']
                 if raw_text:
-                    parsed_data = parse_pasted_data(raw_text, rider_name, year)
-                    st.session_state.all_processed_data.extend(parsed_data)
+                    parsed_seasons.append(parse_season(raw_text, rider_name, year))
 
-    if not st.session_state.all_processed_data:
+    # The DataFrame is built once here and reused by every rerun until the next Process click
+    st.session_state.processed_df = build_results_df(parsed_seasons) if any(season['Date'] for season in parsed_seasons) else None
+    # A digest of the parsed columns keys the cached dashboard aggregations
+    st.session_state.processed_key = hashlib.blake2b(repr(parsed_seasons).encode(), digest_size=16).hexdigest()
+    if st.session_state.processed_df is None:
         st.error("No data was processed. Please paste some results data into the text areas.")
     else:
         st.success("Data processed successfully! Dashboard is ready below.")
 
 # --- Step 3: The Dashboard (only shows if data has been processed) ---
-if st.session_state.all_processed_data:
+if st.session_state.processed_df is not None:
     st.markdown("---")
     st.header(f"Dashboard for {team_name}")
     
-    df = pd.DataFrame(st.session_state.all_processed_data)
+    df = st.session_state.processed_df
     
     st.subheader("Filter and View Data")
     all_riders = df['Rider'].unique()
@@ -143,7 +214,10 @@ if st.session_state.all_processed_data:
     if not selected_riders:
         st.warning("Please select at least one rider to see the analysis.")
     else:
-        filtered_df = df[df['Rider'].isin(selected_riders)].copy()
+        # Rider is categorical, so isin matches on its integer codes; nothing below writes to the frame, so it is not copied
+        filtered_df = df[df['Rider'].isin(selected_riders)]
+        # Filtering keeps row order, so the same set of riders always gives the same frame
+        selection_key = tuple(sorted(selected_riders))
         
         tab1, tab2, tab3, tab4 = st.tabs(["📈 Overall Comparison", "⏱️ Results Over Time", " riders Deep Dive", "📋 Raw Data Table"])
 
@@ -153,40 +227,33 @@ if st.session_state.all_processed_data:
 
             with col1:
                 st.markdown("#### Race Days Comparison")
-                race_days = filtered_df.groupby('Rider').size().reset_index(name='Race Days')
+                race_days = race_days_by_rider(st.session_state.processed_key, selection_key, filtered_df)
                 st.bar_chart(race_days, x='Rider', y='Race Days', use_container_width=True)
 
             with col2:
                 st.markdown("#### Average Result by Month")
-                df_monthly = filtered_df.copy()
-                df_monthly['Result_Numeric'] = pd.to_numeric(df_monthly['Result'], errors='coerce')
-                df_monthly['Month'] = df_monthly['Date'].apply(lambda x: int(x.split('.')[1]))
-                monthly_performance = df_monthly.dropna(subset=['Result_Numeric']).groupby(['Rider', 'Month'])['Result_Numeric'].mean().reset_index()
-                pivot_df = monthly_performance.pivot(index='Month', columns='Rider', values='Result_Numeric')
+                pivot_df = monthly_average_results(st.session_state.processed_key, selection_key, filtered_df)
                 st.line_chart(pivot_df, use_container_width=True)
                 st.caption("Lower is better. Shows the average placing for each month.")
 
         with tab2:
             st.subheader("All Race Results Over Time")
-            df_scatter = filtered_df.copy()
-            df_scatter['Result_Numeric'] = pd.to_numeric(df_scatter['Result'], errors='coerce')
-            df_scatter.dropna(subset=['Result_Numeric'], inplace=True)
-            df_scatter['Full_Date'] = pd.to_datetime(df_scatter['Date'] + '.' + df_scatter['Year'].astype(str), format='%d.%m.%Y')
+            df_scatter = dated_numeric_results(st.session_state.processed_key, selection_key, filtered_df)
             
             st.scatter_chart(df_scatter, x='Full_Date', y='Result_Numeric', color='Rider', use_container_width=True)
             st.caption("Each point represents a single race result. Lower is better.")
 
         with tab3:
             st.subheader("Detailed Rider Breakdown")
-            for rider in sorted(selected_riders):
-                rider_df = filtered_df[filtered_df['Rider'] == rider].copy()
-                
+            # One groupby pass splits out every selected rider's rows (in name order, as Rider's categories are sorted);
+            # Result_Numeric is already on the frame, so the rows are only read, not copied and re-parsed
+            kpis = rider_kpis(st.session_state.processed_key, selection_key, filtered_df)
+            for rider, rider_df in filtered_df.groupby('Rider', sort=True, observed=True):
                 with st.expander(f"View details for {rider}"):
-                    rider_df['Result_Numeric'] = pd.to_numeric(rider_df['Result'], errors='coerce')
-                    
-                    total_race_days = len(rider_df)
-                    total_distance = rider_df['Distance'].sum()
-                    top_10s = len(rider_df[rider_df['Result_Numeric'] <= 10])
+                    rider_kpi = kpis.loc[rider]
+                    total_race_days = int(rider_kpi['race_days'])
+                    total_distance = rider_kpi['total_distance']
+                    top_10s = int(rider_kpi['top_10s'])
 
                     kpi_cols = st.columns(3)
                     kpi_cols[0].metric(label="Total Race Days", value=total_race_days)
@@ -194,7 +261,8 @@ if st.session_state.all_processed_data:
                     kpi_cols[2].metric(label="Top 10 Finishes", value=top_10s)
 
                     st.markdown("**Best 3 Results**")
-                    best_results = rider_df.dropna(subset=['Result_Numeric']).sort_values('Result_Numeric').head(3)
+                    # nsmallest picks the top three without sorting every result
+                    best_results = rider_df.dropna(subset=['Result_Numeric']).nsmallest(3, 'Result_Numeric')
                     
                     if best_results.empty:
                         st.write("No numeric results found to determine best performances.")
@@ -204,6 +272,6 @@ if st.session_state.all_processed_data:
         
         with tab4:
             st.subheader("Processed Data")
-            st.dataframe(filtered_df, use_container_width=True)
+            st.dataframe(filtered_df[RESULT_COLUMNS], use_container_width=True)
 
 
@@ -0,0 +1,142 @@
+# Numba kernels and pandas helpers shared by the Streamlit app (Crit-study.py).
+# Kept in an importable module so the kernels are compiled/loaded once per process, not on every script rerun.
+import math
+import numpy as np
+import pandas as pd
+from numba import njit, types
+
+# Explicit signatures make Numba compile (or load from its on-disk cache) at import time instead of on first call
+# Inputs are typed read-only so pandas' copy-on-write arrays match too; writable arrays convert implicitly
+_F4_IN = types.Array(types.float32, 1, 'C', readonly=True)
+_FIND_BOUTS_SIG = types.Tuple((types.float64[:], types.int64[:], types.float64[:]))(
+    _F4_IN, _F4_IN, types.float64, types.float64, types.int64, types.int64)
+_WBAL_SIG = types.float32[::1](_F4_IN, types.float64, types.float64, types.float64, types.float64)
+
+@njit(_FIND_BOUTS_SIG, cache=True, fastmath=True, nogil=True)
+def find_bouts(time_arr, power_arr, cp, threshold_factor, min_dur, gap_tol):
+    """Runs the bout state machine over raw arrays; returns (start_times, durations, magnitudes)."""
+    # time_arr and power_arr are float32 to halve memory traffic; the running sums below stay float64 for precision
+    n = power_arr.shape[0]
+    threshold_power = cp * threshold_factor
+    # Every recorded bout spans at least min_dur samples, which bounds the output size
+    max_bouts = n // min_dur + 1
+    starts = np.empty(max_bouts, dtype=np.float64)
+    durs = np.empty(max_bouts, dtype=np.int64)
+    mags = np.empty(max_bouts, dtype=np.float64)
+    k = 0
+    duration, avg_power, below_counter, start_time = 0, 0.0, 0, 0.0
+
+    for i in range(n):
+        p = power_arr[i]
+        if p > threshold_power:
+            if duration == 0: start_time = time_arr[i]
+            duration += 1
+            avg_power += p
+            below_counter = 0
+        elif duration > 0:
+            below_counter += 1
+            if below_counter <= gap_tol:
+                # If within tolerance, continue the bout
+                duration += 1
+                avg_power += p
+            else:
+                # If gap is too long, end the bout
+                if duration >= min_dur:
+                    magnitude = (avg_power / duration / cp) * 100
+                    if magnitude >= threshold_factor * 100:
+                        starts[k], durs[k], mags[k] = start_time, duration, magnitude
+                        k += 1
+                duration, avg_power, below_counter = 0, 0.0, 0
+
+    # Check for a bout that might be ongoing at the end of the file
+    if duration >= min_dur:
+        magnitude = (avg_power / duration / cp) * 100
+        if magnitude >= threshold_factor * 100:
+            starts[k], durs[k], mags[k] = start_time, duration, magnitude
+            k += 1
+    return starts[:k], durs[:k], mags[:k]
+
+@njit(_WBAL_SIG, cache=True, fastmath=True, nogil=True)
+def w_prime_balance(power_arr, cp, w_prime, A, B):
+    """Runs the differential W' balance recurrence over a power array."""
+    # power_arr is float32 and so is the stored balance; w_balance itself is carried in float64
+    # so long rides don't accumulate rounding error
+    n = power_arr.shape[0]
+    w_bal = np.empty(n, dtype=np.float32)
+    # The recovery factor depends only on power, so compute it for every sample up front;
+    # this keeps exp/pow off the loop-carried w_balance dependency chain below
+    recovery = np.zeros(n, dtype=np.float64)
+    # Power and CP are whole watts in practice, so tabulate the factor once per watt of deficit (at most CP entries)
+    # and only evaluate exp/pow directly for fractional deficits
+    lut_size = int(cp) + 1
+    lut = np.zeros(lut_size, dtype=np.float64)
+    for d in range(1, lut_size):
+        tau = A * (float(d) ** B)
+        if tau > 0:
+            lut[d] = 1 - math.exp(-1 / tau)
+    for i in range(n):
+        delta_p = cp - power_arr[i]
+        if delta_p > 0:
+            d = int(delta_p)
+            if d == delta_p and d < lut_size:
+                recovery[i] = lut[d]
+            else:
+                tau = A * (delta_p ** B)
+                if tau > 0:
+                    recovery[i] = 1 - math.exp(-1 / tau)
+    w_balance = w_prime
+    for i in range(n):
+        p = power_arr[i]
+        if p > cp:
+            w_balance -= (p - cp)  # Expenditure
+        else:
+            w_balance += (w_prime - w_balance) * recovery[i]  # Recovery (factor is 0 when there is none)
+        w_balance = min(w_prime, max(0.0, w_balance))
+        w_bal[i] = w_balance
+    return w_bal
+
+def combine_bouts(all_files_data):
+    """Concatenates every file's bouts column by column into a single DataFrame."""
+    columns = ['start_time', 'duration', 'magnitude']
+    combined = pd.DataFrame({col: np.concatenate([f['bouts_df'][col].to_numpy() for f in all_files_data]) for col in columns})
+    # Arrow-backed colour strings concatenate as Arrow chunks, without materialising Python str objects
+    combined['color'] = pd.concat([f['bouts_df']['color'] for f in all_files_data], ignore_index=True)
+    return combined
+
+def sum_file_field(all_files_data, key):
+    """Sums one numeric field across every file's results with a single NumPy reduction."""
+    return int(np.fromiter((f[key] for f in all_files_data), dtype=np.int64, count=len(all_files_data)).sum())
+
+def combine_zone_seconds(all_files_data):
+    """Sums every file's seconds per W'bal zone in one reduction over the stacked zone columns."""
+    # Every file's zone table has the same six zones in the same order, so no index alignment is needed
+    zone_seconds = np.stack([f['zone_data']['Time (s)'].to_numpy() for f in all_files_data])
+    return pd.Series(zone_seconds.sum(axis=0), index=all_files_data[0]['zone_data'].index)
+
+def calculate_depletions_and_zones(w_bal_series, w_prime, time_series, w_bal_percent=None):
+    """Counts critical depletions and calculates time spent in W' balance zones."""
+    # The total duration for percentage calculation is the length of the selected time series
+    total_duration = len(time_series)
+    depletion_threshold = 0.15 * w_prime
+    # A depletion starts wherever W'bal crosses below the threshold; a leading False counts a start-below as one
+    below = np.concatenate([[False], w_bal_series.to_numpy() < depletion_threshold])
+    crossings = np.flatnonzero(np.diff(below.view(np.int8)) == 1)
+    depletion_count = crossings.size
+    depletion_times = time_series.to_numpy()[crossings].tolist()
+
+    # Callers that already have W'bal as % of W' for these samples pass it in rather than have it recomputed
+    if w_bal_percent is None:
+        w_bal_percent = (w_bal_series.to_numpy() / w_prime) * 100
+    # Zones are [lower, upper) intervals over 0-100%; W'bal is clamped to [0, W'] so every sample falls in one
+    inner_edges = np.array([10, 15, 25, 50, 70])
+    labels = ['0-10%', '10-15%', '15-25%', '25-50%', '50-70%', '70-100%']
+
+    # Locate each sample's zone on the sorted edges and count per zone (an empty selection gives all zeros)
+    zone_index = np.searchsorted(inner_edges, w_bal_percent, side='right')
+    counts = np.bincount(zone_index, minlength=len(labels)).astype(np.int32)
+    zone_counts = pd.Series(counts, index=pd.CategoricalIndex(labels, categories=labels, ordered=True))
+    zone_data = pd.DataFrame({
+        'Time (s)': zone_counts,
+        'Time (%)': (zone_counts / total_duration * 100).round(2) if total_duration > 0 else 0
+    })
+    return depletion_count, zone_data, depletion_times
@@ -0,0 +1,26 @@
+# FIT record decoding for the Streamlit app (Crit-study.py).
+# Decoding is pure Python and holds the GIL, so the app runs it in worker processes; this module is kept
+# free of pandas/Numba so those workers start quickly.
+import io
+import numpy as np
+import fitdecode
+
+def read_fit_power(data):
+    """Decodes the raw bytes of a .fit file into (timestamps, powers) arrays for records with power."""
+    # Only timestamp and power are needed, so stream them into typed buffers (grown by doubling)
+    # Timestamps are kept as raw FIT seconds; only their differences are used
+    timestamps = np.empty(20000, dtype=np.int64)
+    powers = np.empty(20000, dtype=np.float32)
+    n = 0
+    with fitdecode.FitReader(io.BytesIO(data)) as fit:
+        # Extract records that have a non-null power value
+        for frame in fit:
+            if frame.frame_type != fitdecode.FIT_FRAME_DATA or frame.name != 'record': continue
+            power, timestamp = frame.get_value('power', fallback=None), frame.get_raw_value('timestamp', fallback=None)
+            if power is None or timestamp is None: continue
+            if n == len(powers):
+                timestamps = np.concatenate([timestamps, np.empty_like(timestamps)])
+                powers = np.concatenate([powers, np.empty_like(powers)])
+            timestamps[n], powers[n] = timestamp, power
+            n += 1
+    return timestamps[:n], powers[:n]